@@ -1,21 +1,27 @@
 import os
+import io
+import re
 import time
 import numpy as np
 import pandas as pd
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-from matplotlib.font_manager import FontProperties
-import matplotlib
-from flask import Flask, request, abort, send_from_directory
-import random
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+from flask import Flask, request, abort, send_file
+from werkzeug.middleware.proxy_fix import ProxyFix
 import logging
 import traceback
 import sys
-import gc
+import functools
+import hashlib
+import gzip
 import threading
-from datetime import datetime, timedelta
+import multiprocessing
+import signal
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # --- 設定應用程式版本 ---
 APP_VERSION = "v26.0 雲端量化回測版 (內建 10 大策略回測引擎)"
@@ -25,15 +31,63 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 logger = logging.getLogger(__name__)
 
 # --- 設定 matplotlib 後端 ---
-matplotlib.use('Agg')
-
-# 全域繪圖鎖
-plot_lock = threading.Lock()
+@functools.lru_cache(maxsize=None)
+def load_plotting():
+    """第一次畫圖時才載入 matplotlib；主行程只處理 webhook，不必常駐這份記憶體"""
+    import matplotlib
+    matplotlib.use('Agg')
+    # 線圖只需快速出圖：開啟路徑簡化、分段繪製長路徑
+    matplotlib.rcParams.update({
+        'path.simplify': True,
+        'path.simplify_threshold': 1.0,
+        'agg.path.chunksize': 10000,
+        'figure.max_open_warning': 0,
+    })
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+    return Figure, FigureCanvas
+
+CHART_FONT = None
+
+def load_chart_font():
+    """中文字型載入成功才記住；背景下載還沒完成時每次繪圖都重新檢查，下載好之後的圖表就會改用中文字型"""
+    global CHART_FONT
+    if CHART_FONT is None and os.path.exists(font_file):
+        from matplotlib.font_manager import FontProperties
+        try: CHART_FONT = FontProperties(fname=font_file)
+        except: pass
+    return CHART_FONT
+
+# 繪圖行程池：Agg 繪圖吃 CPU，交給子行程平行處理 (matplotlib 只在子行程內載入，每個子行程載入一次)
+# 容器內 os.cpu_count() 是主機核心數，子行程數改由環境變數設定，預設 2 個以免小機器記憶體不足
+CHART_POOL_WORKERS = max(1, int(os.environ.get('CHART_POOL_WORKERS', '2')))
+chart_pool_lock = threading.Lock()
+
+def init_chart_worker():
+    """繪圖子行程不沿用主行程 (gunicorn) 的訊號處理，SIGTERM/SIGINT 回復系統預設"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+def create_chart_pool():
+    """建立繪圖行程池。採 forkserver：子行程由乾淨的 forkserver 行程分出，不會繼承 webhook 執行緒持有的鎖、
+    gunicorn 的訊號處理與監聽 socket，主行程已有多條執行緒時 (例如行程池失效後重建) 也能安全建立"""
+    pool = ProcessPoolExecutor(max_workers=CHART_POOL_WORKERS, mp_context=multiprocessing.get_context('forkserver'),
+                               initializer=init_chart_worker)
+    # 先送一個空工作，讓 forkserver 與第一個子行程在背景啟動，第一張圖不必等
+    pool.submit(os.getpid)
+    return pool
+
+CHART_TIMEOUT_SECONDS = 30
+CHART_MAX_POINTS = 2000
+render_local = threading.local()
 
 app = Flask(__name__)
+# 平台在前端終止 TLS 後以 http 轉進來；依 X-Forwarded-Proto/Host 還原，request.host_url 直接就是 https 網址
+app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
 from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
 from linebot.models import MessageEvent, TextMessage, TextSendMessage, ImageSendMessage
 
 # --- 1. 設定密鑰 (純雲端環境變數讀取) ---
@@ -44,77 +98,155 @@ FINMIND_TOKEN = os.environ.get('FINMIND_TOKEN', '')
 if not LINE_CHANNEL_ACCESS_TOKEN or not LINE_CHANNEL_SECRET:
     logger.error("❌ 嚴重錯誤：找不到 LINE 密鑰！請確認 Render 環境變數是否已設定。")
 
+# LINE SDK 預設每次 requests.post 都新開連線；改用共用 Session 保持 keep-alive，回覆免重做 TLS 握手
+LINE_SESSION = requests.Session()
+LINE_SESSION.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=16))
+# 長篇中文回覆可壓縮後再上傳；LINE 文件未明載支援 gzip 請求，預設關閉，設 LINE_GZIP_REQUESTS=1 開啟
+LINE_GZIP_REQUESTS = os.environ.get('LINE_GZIP_REQUESTS', '') == '1'
+LINE_GZIP_MIN_BYTES = 1024
+
+class SessionHttpClient(RequestsHttpClient):
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return RequestsHttpResponse(LINE_SESSION.get(
+            url, headers=headers, params=params, stream=stream, timeout=timeout or self.timeout))
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        if LINE_GZIP_REQUESTS and isinstance(data, str):
+            raw = data.encode('utf-8')
+            if len(raw) > LINE_GZIP_MIN_BYTES:
+                data = gzip.compress(raw)
+                headers = {**(headers or {}), 'Content-Encoding': 'gzip'}
+        return RequestsHttpResponse(LINE_SESSION.post(
+            url, headers=headers, data=data, timeout=timeout or self.timeout))
+
 # 只有在金鑰存在時才初始化
 if LINE_CHANNEL_ACCESS_TOKEN and LINE_CHANNEL_SECRET:
-    line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
+    line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN, http_client=SessionHttpClient)
     handler = WebhookHandler(LINE_CHANNEL_SECRET)
 
-# --- 2. 準備字型與圖片目錄 ---
-static_dir = 'static_images'
-if not os.path.exists(static_dir):
-    try: os.makedirs(static_dir)
-    except Exception as e: logger.error(f"無法建立目錄: {e}")
-
+# --- 2. 準備字型 ---
 font_file = 'TaipeiSansTCBeta-Regular.ttf'
-if not os.path.exists(font_file):
+
+def download_font():
+    """字型隨專案一起部署；萬一缺檔才補抓，先存暫存檔再改名，繪圖端不會讀到下載一半的檔案"""
     try:
         import urllib.request
         url = "https://drive.google.com/uc?id=1eGAsTN1HBpJAkeVM57_C7ccp7hbgSz3_&export=download"
-        urllib.request.urlretrieve(url, font_file)
+        tmp_file = font_file + '.part'
+        urllib.request.urlretrieve(url, tmp_file)
+        os.replace(tmp_file, font_file)
     except Exception as e: logger.error(f"字型下載失敗: {e}")
 
-try: my_font = FontProperties(fname=font_file)
-except: my_font = None
-
 # --- 3. 全域快取與使用者狀態 ---
-INFO_CACHE = {}
-BENCHMARK_CACHE = {'data': None, 'time': 0}
+# 基本面 (PE) 與 FinMind 原始回應皆為 LRU + TTL，上限內保留最近查過的代號，不隨使用者亂輸入無限長大
+INFO_CACHE = OrderedDict()
+INFO_CACHE_MAX = 512
+INFO_CACHE_TTL_SECONDS = 86400
+info_lock = threading.Lock()
+BENCHMARK_CACHE = {'data': None, 'time': 0, 'failed': 0}
+BENCHMARK_TTL_SECONDS = 3600
+BENCHMARK_RETRY_SECONDS = 60
+benchmark_lock = threading.Lock()
+FINMIND_CACHE = OrderedDict()
+FINMIND_CACHE_MAX = 512
+FINMIND_TTL_SECONDS = 3600
+FINMIND_HISTORY_TTL_SECONDS = 86400
+finmind_lock = threading.Lock()
+WATCHLIST_CACHE = {'data': {}, 'time': 0}
+WATCHLIST_REFRESH_SECONDS = 600
+watchlist_lock = threading.Lock()
+# 線圖 PNG 直接存在記憶體 (LRU)，LINE 取圖時由 /images 路由回傳，不落地
+IMG_CACHE = OrderedDict()
+IMG_CACHE_MAX = 128
+IMG_CACHE_TTL_SECONDS = 86400
+img_lock = threading.Lock()
 USER_USAGE = {}
+USER_USAGE_MAX = 10000
 MAX_REQUESTS_PER_WINDOW = 15
 WINDOW_SECONDS = 300
 COOLDOWN_SECONDS = 600
+# 令牌桶限流：桶容量即每個視窗的額度，令牌依視窗長度平均回補，跨視窗邊界也不會多放一倍請求
+USER_TOKEN_CAPACITY = MAX_REQUESTS_PER_WINDOW
+USER_TOKEN_RATE = MAX_REQUESTS_PER_WINDOW / WINDOW_SECONDS
+usage_lock = threading.Lock()
+
+def prune_user_usage(now):
+    """清除閒置超過冷卻期兩倍的使用者紀錄 (呼叫端需持有 usage_lock)"""
+    for uid in [u for u, d in USER_USAGE.items() if now - d['last_refill'] > COOLDOWN_SECONDS * 2]:
+        del USER_USAGE[uid]
 
 def check_user_state(user_id):
-    now = datetime.now()
-    if user_id not in USER_USAGE:
-        USER_USAGE[user_id] = {'last_time': now, 'count': 1, 'cooldown_until': None}
-        return False, ""
-    
-    user_data = USER_USAGE[user_id]
-    if user_data['cooldown_until'] and now < user_data['cooldown_until']:
-        remaining = int((user_data['cooldown_until'] - now).total_seconds() / 60)
-        return True, f"⛔ **情緒熔斷啟動**\n操作過頻，強制冷靜 {remaining} 分鐘。"
-    
-    if (now - user_data['last_time']).total_seconds() < WINDOW_SECONDS:
-        user_data['count'] += 1
-    else:
-        user_data['count'] = 1
-        user_data['last_time'] = now
-    
-    if user_data['count'] > MAX_REQUESTS_PER_WINDOW:
-        user_data['cooldown_until'] = now + timedelta(seconds=COOLDOWN_SECONDS)
-        return True, f"⛔ **過度交易警示**\n頻率過高，系統鎖定 10 分鐘。"
+    now = time.monotonic()
+    with usage_lock:
+        user_data = USER_USAGE.get(user_id)
+        if user_data is None:
+            if len(USER_USAGE) >= USER_USAGE_MAX: prune_user_usage(now)
+            USER_USAGE[user_id] = {'tokens': USER_TOKEN_CAPACITY - 1, 'last_refill': now, 'cooldown_until': 0.0}
+            return False, ""
+        
+        if now < user_data['cooldown_until']:
+            remaining = int((user_data['cooldown_until'] - now) / 60)
+            return True, f"⛔ **情緒熔斷啟動**\n操作過頻，強制冷靜 {remaining} 分鐘。"
+        
+        user_data['tokens'] = min(USER_TOKEN_CAPACITY, user_data['tokens'] + (now - user_data['last_refill']) * USER_TOKEN_RATE)
+        user_data['last_refill'] = now
+        
+        if user_data['tokens'] < 1:
+            user_data['cooldown_until'] = now + COOLDOWN_SECONDS
+            return True, f"⛔ **過度交易警示**\n頻率過高，系統鎖定 10 分鐘。"
+        user_data['tokens'] -= 1
     
     return False, ""
 
 # --- ★ 核心：FinMind API 串接模組 ---
+# 共用連線池 (keep-alive)，省去每次 TLS 握手；暫時性錯誤自動重試
+FINMIND_SESSION = requests.Session()
+FINMIND_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=10, pool_maxsize=20,
+    max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"])
+))
+# Token 改放在 Session 的 Authorization 標頭 (FinMind v4 支援)，設定一次即可，也不會出現在網址與錯誤紀錄裡
+if FINMIND_TOKEN:
+    FINMIND_SESSION.headers['Authorization'] = f"Bearer {FINMIND_TOKEN}"
+# FinMind 抓取共用同一組執行緒：選股、預抓、回測不必各自開池，同時對 FinMind 的連線數也有上限
+FETCH_POOL = ThreadPoolExecutor(max_workers=10)
+# 個股診斷的本益比/大盤預抓另用一組小執行緒池，不必排在整批自選股更新或選股後面
+LOOKUP_POOL = ThreadPoolExecutor(max_workers=4)
+
+@functools.lru_cache(maxsize=32)
+def start_date_for(days, today_ordinal):
+    """往前推 days 天的起始日 (YYYY-MM-DD)；一天只會變一次，依 (天數, 今日序號) 快取字串"""
+    return (date.fromordinal(today_ordinal) - timedelta(days=days)).isoformat()
+
 def call_finmind_api(dataset, data_id, start_date=None, days=365):
-    """通用 FinMind API 呼叫函式 (Sponsor 權限)"""
+    """通用 FinMind API 呼叫函式 (Sponsor 權限)，同一查詢在 TTL 內直接回傳快取"""
     url = "https://api.finmindtrade.com/api/v4/data"
+    # 指定起始日的歷史 K 線 (回測區間) 快取 24 小時，其餘查詢 1 小時
+    ttl = FINMIND_HISTORY_TTL_SECONDS if (start_date and dataset == "TaiwanStockPrice") else FINMIND_TTL_SECONDS
     if start_date is None:
-        start_date = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+        start_date = start_date_for(days, date.today().toordinal())
+    cache_key = (dataset, data_id, start_date)
+    with finmind_lock:
+        cached = FINMIND_CACHE.get(cache_key)
+        if cached and (time.time() - cached[0]) < ttl:
+            FINMIND_CACHE.move_to_end(cache_key)
+            return cached[1].copy()
     params = {
         "dataset": dataset, 
         "data_id": data_id, 
-        "start_date": start_date, 
-        "token": FINMIND_TOKEN
+        "start_date": start_date
     }
     try:
-        r = requests.get(url, params=params, timeout=10)
+        r = FINMIND_SESSION.get(url, params=params, timeout=(3, 10))
         if r.status_code == 200:
             j = r.json()
             if j.get('msg') == 'success' and j.get('data'): 
-                return pd.DataFrame(j['data'])
+                df = pd.DataFrame(j['data'])
+                with finmind_lock:
+                    FINMIND_CACHE[cache_key] = (time.time(), df)
+                    FINMIND_CACHE.move_to_end(cache_key)
+                    while len(FINMIND_CACHE) > FINMIND_CACHE_MAX: FINMIND_CACHE.popitem(last=False)
+                return df.copy()
     except Exception as e:
         logger.error(f"FinMind API Error ({dataset} - {data_id}): {e}")
     return pd.DataFrame()
@@ -129,18 +261,26 @@ def fetch_data_finmind(stock_code, days=400, start_date=None):
     
     # 格式整理成標準 OHLCV
     df = df.rename(columns={'date':'Date','open':'Open','max':'High','min':'Low','close':'Close','Trading_Volume':'Volume'})
-    df['Date'] = pd.to_datetime(df['Date'])
+    df['Date'] = pd.to_datetime(df['Date'], format='%Y-%m-%d', cache=True)
     df = df.set_index('Date').sort_index()
-    for c in ['Open','High','Low','Close','Volume']: 
-        if c in df.columns: df[c] = pd.to_numeric(df[c], errors='coerce')
+    cols = [c for c in ['Open','High','Low','Close'] if c in df.columns]
+    # 價格轉 float32，自選股快取 (WATCHLIST_CACHE) 與送往繪圖子行程的資料量減半；
+    # FINMIND_CACHE 存的是原始回應，不在此列。指標運算時再升為 float64 累加
+    df[cols] = df[cols].apply(pd.to_numeric, errors='coerce').astype(np.float32)
+    # 成交量 (股) 常超過 float32 可精確表示的整數範圍 (約 1677 萬)，改存 int64
+    if 'Volume' in df.columns:
+        df['Volume'] = pd.to_numeric(df['Volume'], errors='coerce').fillna(0).astype(np.int64)
     
     return df.dropna(subset=['Close'])
 
 def get_stock_info_finmind(stock_code):
     """專責抓取基本面 (PE)"""
     clean_code = stock_code.split('.')[0]
-    if clean_code in INFO_CACHE:
-        return INFO_CACHE[clean_code]
+    with info_lock:
+        item = INFO_CACHE.get(clean_code)
+        if item and (time.time() - item[0]) < INFO_CACHE_TTL_SECONDS:
+            INFO_CACHE.move_to_end(clean_code)
+            return item[1]
         
     df_per = call_finmind_api("TaiwanStockPER", clean_code, days=15)
     data = {'eps': 'N/A', 'pe': 'N/A'}
@@ -149,28 +289,41 @@ def get_stock_info_finmind(stock_code):
         p = last.get('PER', 0)
         data['pe'] = p if pd.notna(p) and p > 0 else 'N/A'
     
-    INFO_CACHE[clean_code] = data
+    with info_lock:
+        INFO_CACHE[clean_code] = (time.time(), data)
+        INFO_CACHE.move_to_end(clean_code)
+        while len(INFO_CACHE) > INFO_CACHE_MAX: INFO_CACHE.popitem(last=False)
     return data
 
 def get_eps_from_price_pe(price, pe):
     try:
         if pe != 'N/A' and float(pe) > 0: 
-            return round(price / float(pe), 2)
+            return round(float(price) / float(pe), 2)
     except: pass
     return 'N/A'
 
 def get_benchmark_data():
-    """專責抓取加權指數做大盤指標"""
+    """專責抓取加權指數做大盤指標 (同時間只讓一個請求去抓，其餘等待共用結果)；
+    抓取失敗後 BENCHMARK_RETRY_SECONDS 內不再重抓，FinMind 故障時不會讓每個等待者輪流重試"""
     now = time.time()
-    if BENCHMARK_CACHE['data'] is not None and (now - BENCHMARK_CACHE['time']) < 3600:
+    if BENCHMARK_CACHE['data'] is not None and (now - BENCHMARK_CACHE['time']) < BENCHMARK_TTL_SECONDS:
         return BENCHMARK_CACHE['data']
     
-    bench = fetch_data_finmind("TAIEX", days=400)
-    if not bench.empty and len(bench) > 20:
-        BENCHMARK_CACHE['data'] = bench
-        BENCHMARK_CACHE['time'] = now
-        return bench
-    return pd.DataFrame()
+    if now - BENCHMARK_CACHE['failed'] >= BENCHMARK_RETRY_SECONDS:
+        with benchmark_lock:
+            now = time.time()
+            if BENCHMARK_CACHE['data'] is not None and (now - BENCHMARK_CACHE['time']) < BENCHMARK_TTL_SECONDS:
+                return BENCHMARK_CACHE['data']
+            # 等鎖期間前一位已抓失敗，就不再重抓
+            if now - BENCHMARK_CACHE['failed'] >= BENCHMARK_RETRY_SECONDS:
+                bench = fetch_data_finmind("TAIEX", days=400)
+                if not bench.empty and len(bench) > 20:
+                    BENCHMARK_CACHE['data'] = bench
+                    BENCHMARK_CACHE['time'] = now
+                    return bench
+                BENCHMARK_CACHE['failed'] = time.time()
+    # 更新失敗 (或仍在退避時間內) 時先沿用上一份大盤資料
+    return BENCHMARK_CACHE['data'] if BENCHMARK_CACHE['data'] is not None else pd.DataFrame()
 
 # --- 4. 資料庫定義 (完整版) ---
 SECTOR_DICT = {
@@ -182,6 +335,14 @@ SECTOR_DICT = {
     "AI": ['3231', '2382', '6669', '2376', '2356', '3017'],
 }
 
+# 成分股清單去重 (保持原順序)，手動維護時重複列入也不會重複抓取
+SECTOR_DICT = {k: list(dict.fromkeys(v)) for k, v in SECTOR_DICT.items()}
+
+# 類股名稱依長度由長到短排序 (同長度維持原順序)，同時命中時以最長的名稱為準，之後新增類股也不會被短名稱搶先
+SECTOR_KEYS = sorted(SECTOR_DICT, key=len, reverse=True)
+# 類股名稱預先編成單一正則，訊息只需掃描一次
+SECTOR_PATTERN = re.compile("|".join(map(re.escape, SECTOR_KEYS)))
+
 CODE_NAME_MAP = {
     '2330': '台積電', '2454': '聯發科', '2303': '聯電', '2317': '鴻海', '2409': '友達', '2603': '長榮', '1605': '華新', '2609': '陽明', '3481': '群創', '2615': '萬海', '2618': '長榮航', '2610': '華航', '2637': '慧洋', '2606': '裕民', '2002': '中鋼', '2014': '中鴻', '2027': '大成鋼', '1301': '台塑', '1402': '遠東新', '1101': '台泥', '2881': '富邦金', '2882': '國泰金', '0050': '元大台灣50', '0056': '元大高股息', '3231': '緯創', '2382': '廣達', '2376': '技嘉', '2356': '英業達', '3037': '欣興', '2324': '仁寶', '2357': '華碩', '5880': '合庫金', '2891': '中信金', '2892': '第一金', '2886': '兆豐金', '2884': '玉山金', '2885': '元大金', '2890': '永豐金', '2883': '開發金', '2887': '台新金', '2880': '華南金', '2834': '臺企銀', '2801': '彰銀', '1102': '亞泥', '1907': '永豐餘', '2105': '正新', '9945': '潤泰新', '2542': '興富發', '00878': '國泰永續', '00929': '復華科優息', '00919': '群益精選', '2353': '宏碁', '2352': '佳世達', '2408': '南亞科', '2344': '華邦電', '2337': '旺宏', '3702': '大聯大', '2312': '金寶', '6282': '康舒', '3260': '威剛', '8150': '南茂', '6147': '頎邦', '5347': '世界', '2363': '矽統', '2449': '京元電', '3036': '文曄'
 }
@@ -190,84 +351,179 @@ def get_stock_name(stock_code):
     clean = stock_code.split('.')[0]
     return CODE_NAME_MAP.get(clean, clean)
 
+def refresh_watchlist_cache():
+    """預抓所有類股成分股 K 線與大盤，選股時直接讀記憶體"""
+    codes = sorted({c for lst in SECTOR_DICT.values() for c in lst})
+    frames = dict(zip(codes, FETCH_POOL.map(fetch_data_finmind, codes)))
+    with watchlist_lock:
+        WATCHLIST_CACHE['data'] = {c: df for c, df in frames.items() if not df.empty}
+        WATCHLIST_CACHE['time'] = time.time()
+    get_benchmark_data()
+
+def start_watchlist_refresher():
+    """背景定時刷新選股資料 (每 10 分鐘)"""
+    try: refresh_watchlist_cache()
+    except Exception as e: logger.error(f"選股資料預抓失敗: {e}")
+    timer = threading.Timer(WATCHLIST_REFRESH_SECONDS, start_watchlist_refresher)
+    timer.daemon = True
+    timer.start()
+
+def get_watchlist_data(stock_code):
+    """優先讀背景快取，過期或缺漏才即時抓取"""
+    with watchlist_lock:
+        fresh = (time.time() - WATCHLIST_CACHE['time']) < WATCHLIST_REFRESH_SECONDS * 2
+        df = WATCHLIST_CACHE['data'].get(stock_code) if fresh else None
+    return df if df is not None else fetch_data_finmind(stock_code)
+
 # --- 5. 核心計算函數 ---
-def calculate_adx(df, window=14):
-    try:
-        high, low, close = df['High'], df['Low'], df['Close']
-        up, down = high.diff(), -low.diff()
+def rolling_mean_2d(arr, window):
+    """二維 (天數 × 股票) 移動平均，以 cumsum 差分一次算完所有股票；視窗內含 NaN 則為 NaN (同 pandas rolling)"""
+    arr = np.asarray(arr, dtype=float)
+    valid = ~np.isnan(arr)
+    csum = np.cumsum(np.where(valid, arr, 0.0), axis=0)
+    ccnt = np.cumsum(valid, axis=0)
+    sums = csum[window-1:].copy(); cnts = ccnt[window-1:].copy()
+    sums[1:] -= csum[:-window]; cnts[1:] -= ccnt[:-window]
+    out = np.full(arr.shape, np.nan)
+    out[window-1:] = np.where(cnts == window, sums / window, np.nan)
+    return out
+
+def true_range(high, low, close):
+    """真實波幅 TR (NumPy 陣列)，首日無前收時取高低差"""
+    prev_close = np.full(close.shape, np.nan); prev_close[1:] = close[:-1]
+    return np.fmax(np.fmax(high - low, np.abs(high - prev_close)), np.abs(low - prev_close))
+
+def calculate_rsi(close, window=14):
+    """RSI (簡單平均版)，可傳一維或 (天數 × 股票) 陣列。
+    視窗內漲幅和 = (|漲跌|和 + 淨漲跌) / 2，淨漲跌就是頭尾收盤差，所以只需算一條 |漲跌| 的移動平均"""
+    close = np.asarray(close, dtype=float)
+    rsi = np.full(close.shape, np.nan)
+    if len(close) < window: return rsi
+    delta = np.zeros(close.shape); delta[1:] = np.diff(close, axis=0)
+    avg_move = rolling_mean_2d(np.abs(delta), window)[window-1:]
+    # 首個視窗含第 0 天 (漲跌記 0)，起點同樣取第 0 天收盤
+    net = close[window-1:] - np.concatenate((close[:1], close[:len(close)-window]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rsi[window-1:] = 50 * (1 + net / (avg_move * window))
+    return rsi
+
+def on_balance_volume(close, volume):
+    """OBV (NumPy 陣列)：依漲跌方向累加成交量，平盤或缺值當天不計"""
+    d = np.zeros_like(close)
+    np.subtract(close[1:], close[:-1], out=d[1:])
+    flow = np.sign(d) * volume
+    flow[np.isnan(flow)] = 0
+    return np.cumsum(flow)
+
+def directional_indicators(high, low, close, window=14):
+    """ADX 與 ATR (NumPy 陣列)，兩者共用同一條 TR"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        atr = rolling_mean_2d(true_range(high, low, close), window)
+        up = np.full(high.shape, np.nan); up[1:] = np.diff(high)
+        down = np.full(low.shape, np.nan); down[1:] = -np.diff(low)
         plus_dm = np.where((up > down) & (up > 0), up, 0.0)
         minus_dm = np.where((down > up) & (down > 0), down, 0.0)
-        tr = pd.concat([high-low, abs(high-close.shift(1)), abs(low-close.shift(1))], axis=1).max(axis=1)
-        atr = tr.rolling(window).mean()
-        plus_di = 100 * (pd.Series(plus_dm, index=df.index).rolling(window).mean() / atr)
-        minus_di = 100 * (pd.Series(minus_dm, index=df.index).rolling(window).mean() / atr)
-        dx = (abs(plus_di - minus_di) / (abs(plus_di + minus_di) + 1e-9)) * 100
-        return dx.rolling(window).mean()
-    except: return pd.Series([0]*len(df), index=df.index)
-
-def calculate_atr(df, window=14):
-    try:
-        tr = pd.concat([df['High']-df['Low'], abs(df['High']-df['Close'].shift(1)), abs(df['Low']-df['Close'].shift(1))], axis=1).max(axis=1)
-        return tr.rolling(window).mean()
-    except: return pd.Series([0]*len(df), index=df.index)
+        plus_di = 100 * (rolling_mean_2d(plus_dm, window) / atr)
+        minus_di = 100 * (rolling_mean_2d(minus_dm, window) / atr)
+        dx = (np.abs(plus_di - minus_di) / (np.abs(plus_di + minus_di) + 1e-9)) * 100
+        return rolling_mean_2d(dx, window), atr
+
+def compute_chart_indicators(df):
+    """個股診斷指標一次算完 (MA/斜率/RSI/量比/ADX/ATR/OBV)，直接在 NumPy 陣列上運算"""
+    high, low, close, volume = (df[c].to_numpy(dtype=float) for c in ('High', 'Low', 'Close', 'Volume'))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ma20 = rolling_mean_2d(close, 20)
+        ma60 = rolling_mean_2d(close, 60) if len(close) >= 60 else ma20
+        slope = np.full(ma20.shape, np.nan); slope[5:] = ma20[5:] - ma20[:-5]
+
+        rsi = calculate_rsi(close, 14)
+
+        vol_ma20 = rolling_mean_2d(volume, 20)
+        vol_ratio = volume / vol_ma20
+
+        adx, atr = directional_indicators(high, low, close, 14)
+
+    return {
+        'MA20': ma20, 'MA60': ma60, 'Slope': slope, 'RSI': rsi,
+        'Vol_MA20': vol_ma20, 'Vol_Ratio': vol_ratio,
+        'ADX': adx, 'ATR': atr, 'OBV': on_balance_volume(close, volume)
+    }
 
-def calculate_obv(df):
-    try: return (np.sign(df['Close'].diff()) * df['Volume']).fillna(0).cumsum()
-    except: return pd.Series([0]*len(df), index=df.index)
+# 個股指標快取：資料沒變 (最後一根 K 棒的日期、收盤、量與筆數都相同) 就沿用，每檔只留最新一份
+# 與 INFO_CACHE 相同採 LRU + TTL，上限內保留最近查過的代號
+INDICATOR_CACHE = OrderedDict()
+INDICATOR_CACHE_MAX = 256
+INDICATOR_CACHE_TTL_SECONDS = 3600
+indicator_lock = threading.Lock()
+
+def cached_chart_indicators(code, df):
+    key = (len(df), df.index[-1].value, float(df['Close'].iat[-1]), float(df['Volume'].iat[-1]))
+    now = time.time()
+    with indicator_lock:
+        item = INDICATOR_CACHE.get(code)
+        if item and item[0] == key and (now - item[1]) < INDICATOR_CACHE_TTL_SECONDS:
+            INDICATOR_CACHE.move_to_end(code)
+            return item[2]
+    indicators = compute_chart_indicators(df)
+    with indicator_lock:
+        INDICATOR_CACHE[code] = (key, now, indicators)
+        INDICATOR_CACHE.move_to_end(code)
+        while len(INDICATOR_CACHE) > INDICATOR_CACHE_MAX: INDICATOR_CACHE.popitem(last=False)
+    return indicators
 
 # --- ★ v21.1 K線戰法全攻略引擎 ---
 def detect_kline_pattern(df):
     if len(df) < 5: return "資料不足", 0
-    t0 = df.iloc[-1]; t1 = df.iloc[-2]; t2 = df.iloc[-3]; t3 = df.iloc[-4]; t4 = df.iloc[-5]
-    O0,H0,L0,C0 = t0['Open'], t0['High'], t0['Low'], t0['Close']
-    O1,H1,L1,C1 = t1['Open'], t1['High'], t1['Low'], t1['Close']
-    O2,H2,L2,C2 = t2['Open'], t2['High'], t2['Low'], t2['Close']
+    # 近 5 根 K 棒先切片再轉成 (5 × 4) 陣列，實體/上下影線/紅黑 K 一次算好；索引 -1 今日、-2 昨日、-3 前日
+    o, h, l, c = df[['Open', 'High', 'Low', 'Close']].iloc[-5:].to_numpy(dtype=float).T
+    body = np.abs(c - o)
+    upper = h - np.maximum(c, o)
+    lower = np.minimum(c, o) - l
+    red = c > o
+    green = c < o
+    O0, L0, C0, C1, C2, L2 = o[-1], l[-1], c[-1], c[-2], c[-3], l[-3]
     
-    def body(r): return abs(r['Close']-r['Open'])
-    def upper(r): return r['High'] - max(r['Close'], r['Open'])
-    def lower(r): return min(r['Close'], r['Open']) - r['Low']
-    def is_red(r): return r['Close'] > r['Open']
-    def is_green(r): return r['Close'] < r['Open']
-    def is_doji(r): return body(r) < (r['High']-r['Low']) * 0.1
-    
-    avg_body = np.mean([body(df.iloc[-i]) for i in range(1, 6)])
+    avg_body = body.mean()
     if avg_body == 0: avg_body = 0.1
     
-    ma20 = df['Close'].rolling(20).mean().iloc[-1]
+    # 均線最多只看到近 21 根，不必轉換整段收盤價
+    close = df['Close'].iloc[-21:].to_numpy(dtype=float)
+    n = len(close)
+    ma20 = close[-20:].mean() if n >= 20 else np.nan
     trend_up = C0 > ma20
     trend_down = C0 < ma20
     
-    if is_green(t2) and body(t2) > avg_body and body(t1) < avg_body*0.5 and t1['Close'] < C2 and is_red(t0) and C0 > (t2['Open']+t2['Close'])/2:
+    if green[-3] and body[-3] > avg_body and body[-2] < avg_body*0.5 and C1 < C2 and red[-1] and C0 > (o[-3]+C2)/2:
        return "晨星 (黎明將至) [空轉多] 🌅", 0.95
-    if is_red(t2) and body(t2) > avg_body and body(t1) < avg_body*0.5 and t1['Close'] > C2 and is_green(t0) and C0 < (t2['Open']+t2['Close'])/2:
+    if red[-3] and body[-3] > avg_body and body[-2] < avg_body*0.5 and C1 > C2 and green[-1] and C0 < (o[-3]+C2)/2:
        return "夜星 (黑夜降臨) [多轉空] 🌃", -0.95
-    if is_green(t1) and is_red(t0) and C0 > t1['Open'] and O0 < t1['Close']:
+    if green[-2] and red[-1] and C0 > o[-2] and O0 < C1:
         return "多頭吞噬 (一舉扭轉) [空轉多] 🔥", 0.9
-    if is_red(t1) and is_green(t0) and C0 < t1['Open'] and O0 > t1['Close']:
+    if red[-2] and green[-1] and C0 < o[-2] and O0 > C1:
         return "空頭吞噬 (空方反撲) [多轉空] 🌧️", -0.9
-    if is_green(t1) and is_red(t0) and O0 < t1['Low'] and C0 > (t1['Open']+t1['Close'])/2:
+    if green[-2] and red[-1] and O0 < l[-2] and C0 > (o[-2]+C1)/2:
         return "貫穿線 (多方反擊) [空轉多] 🗡️", 0.8
-    if is_red(t1) and is_green(t0) and O0 > t1['High'] and C0 < (t1['Open']+t1['Close'])/2:
+    if red[-2] and green[-1] and O0 > h[-2] and C0 < (o[-2]+C1)/2:
         return "烏雲蓋頂 (空方壓頂) [多轉空] 🌥️", -0.8
-    if lower(t0) > 2 * body(t0) and upper(t0) < body(t0) * 0.2:
+    if lower[-1] > 2 * body[-1] and upper[-1] < body[-1] * 0.2:
         if trend_down: return "錘頭 (底部支撐) [空轉多] 🔨", 0.7
         if trend_up: return "上吊線 (高檔出貨?) [多轉空] 🎗️", -0.6
-    if upper(t0) > 2 * body(t0) and lower(t0) < body(t0) * 0.2:
+    if upper[-1] > 2 * body[-1] and lower[-1] < body[-1] * 0.2:
         if trend_up: return "流星 (高檔避雷針) [多轉空] ☄️", -0.7
         if trend_down: return "倒狀錘頭 (試盤反彈) [空轉多] ☝️", 0.4
-    if is_red(t0) and is_red(t1) and is_red(t2) and C0>C1>C2:
+    if red[-1] and red[-2] and red[-3] and C0>C1>C2:
         return "紅三兵 (多頭氣盛) [多頭持續] 💂‍♂️", 0.8
-    if is_green(t0) and is_green(t1) and is_green(t2) and C0<C1<C2:
+    if green[-1] and green[-2] and green[-3] and C0<C1<C2:
         return "黑三兵 (烏鴉滿天) [空頭持續] 🐻", -0.8
     
     # 趨勢動態解讀
-    ma5 = df['Close'].rolling(5).mean().iloc[-1]
-    prev_ma5 = df['Close'].rolling(5).mean().iloc[-2]
-    prev_ma20 = df['Close'].rolling(20).mean().iloc[-2]
+    ma5 = close[-5:].mean()
+    prev_ma5 = close[-6:-1].mean() if n >= 6 else np.nan
+    prev_ma20 = close[-21:-1].mean() if n >= 21 else np.nan
     
     if prev_ma5 <= prev_ma20 and ma5 > ma20 and ma5 > prev_ma5 and ma20 > prev_ma20:
         return "鳥嘴攻擊型態 [趨勢啟動] 🐦", 0.9
-    if is_red(t0) and is_green(t1) and is_red(t2) and L0 > L2 and trend_down:
+    if red[-1] and green[-2] and red[-3] and L0 > L2 and trend_down:
          return "W底雛形 (屁股型態) [見底訊號] 🍑", 0.7
     
     if C0 > ma5 and ma5 > ma20: return "多頭排列 (沿5日線強勢) 📈", 0.3
@@ -298,12 +554,13 @@ def get_valuation_status(current_price, ma60, info_data):
 
 def detect_market_state(index_df):
     if index_df.empty: return 'RANGE'
-    last = index_df.iloc[-1]
-    adx = calculate_adx(index_df).iloc[-1]
-    atr = calculate_atr(index_df).iloc[-1]
-    atr_pct = (atr / last['Close']) if last['Close'] > 0 else 0
-    ma20 = index_df['Close'].rolling(20).mean().iloc[-1]
-    ma60 = index_df['Close'].rolling(60).mean().iloc[-1]
+    # 只需要最後一天的值：直接在陣列上取，均線用尾段平均，不建整條 rolling Series
+    high, low, close = (index_df[c].to_numpy(dtype=float) for c in ('High', 'Low', 'Close'))
+    adx, atr = (x[-1] for x in directional_indicators(high, low, close))
+    price = close[-1]
+    atr_pct = (atr / price) if price > 0 else 0
+    ma20 = close[-20:].mean() if len(close) >= 20 else np.nan
+    ma60 = close[-60:].mean() if len(close) >= 60 else np.nan
     if ma20 > ma60 and adx > 25: return 'TREND'
     elif atr_pct < 0.012: return 'RANGE'
     else: return 'VOLATILE'
@@ -313,27 +570,39 @@ def get_market_commentary(state):
     elif state == 'RANGE': return "🟡 今日盤勢：建議觀望\n👉 策略：新手空手，老手區間。\n🛑 額度：最多 1 檔。"
     else: return "🔴 今日盤勢：⛔ 禁止進場\n👉 策略：嚴格風控。\n🛑 額度：🚫 禁止開新倉。"
 
+PSYCHOLOGY_QUOTES = ("💡 心法：Score 高不代表必勝，只代表勝率較高。", "💡 心法：新手死於追高，老手死於抄底。", "💡 心法：連續虧損時，縮小部位或停止交易。", "💡 心法：不持有部位，也是一種部位。", "💡 心法：交易的目標不是全對，而是活得久。")
+
 def get_psychology_reminder():
-    quotes = ["💡 心法：Score 高不代表必勝，只代表勝率較高。", "💡 心法：新手死於追高，老手死於抄底。", "💡 心法：連續虧損時，縮小部位或停止交易。", "💡 心法：不持有部位，也是一種部位。", "💡 心法：交易的目標不是全對，而是活得久。"]
-    return random.choice(quotes)
+    # 依分鐘輪替而非隨機，同一分鐘內相同輸入的回覆完全一致，才能整段快取重用
+    return PSYCHOLOGY_QUOTES[int(time.time() // 60) % len(PSYCHOLOGY_QUOTES)]
+
+# 各盤勢下趨勢/動能/風險分數的權重
+SCORE_WEIGHTS = {
+    'TREND': {'trend': 0.6, 'momentum': 0.3, 'risk': 0.1},
+    'RANGE': {'trend': 0.4, 'momentum': 0.2, 'risk': 0.4},
+    'VOLATILE': {'trend': 0.3, 'momentum': 0.4, 'risk': 0.3},
+}
 
 def calculate_score(df_cand, weights):
-    score_rs = df_cand['rs_rank'] * 100
-    score_ma = np.where(df_cand['ma20'] > df_cand['ma60'], 100, 0)
-    score_trend = (score_rs * 0.7) + (score_ma * 0.3)
-    slope_pct = (df_cand['slope'] / df_cand['price']).fillna(0)
-    score_slope = np.where(slope_pct > 0, (slope_pct * 1000).clip(upper=100), 0)
-    vol = df_cand['vol_ratio']
-    score_vol = np.exp(-((vol - 2.0) ** 2) / 2.0) * 100
-    df_cand['score_momentum'] = (score_slope * 0.4) + (score_vol * 0.6)
-    atr_pct = df_cand['atr'] / df_cand['price']
-    dist = (atr_pct - 0.03).abs()
-    score_risk = (100 - (dist * 100 * 20)).clip(lower=0)
+    rs_rank, ma20, ma60, slope, price, vol, atr = (
+        df_cand[c].to_numpy(dtype=float) for c in ('rs_rank', 'ma20', 'ma60', 'slope', 'price', 'vol_ratio', 'atr'))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ma_up = ma20 > ma60
+        score_trend = rs_rank * 70 + np.where(ma_up, 30.0, 0.0)
+        slope_pct = slope / price
+        slope_pct[np.isnan(slope_pct)] = 0
+        score_slope = np.where(slope_pct > 0, np.minimum(slope_pct * 1000, 100), 0.0)
+        score_vol = np.exp(-((vol - 2.0) ** 2) / 2.0) * 100
+        score_momentum = score_slope * 0.4 + score_vol * 0.6
+        score_risk = np.maximum(100 - np.abs(atr / price - 0.03) * 2000, 0)
+        total = score_trend * weights['trend']
+        total += score_momentum * weights['momentum']
+        total += score_risk * weights['risk']
+    is_aplus = (rs_rank >= 0.85) & ma_up & (slope > 0) & (vol >= 1.5) & (vol <= 2.5) & (score_risk > 60)
+    total[is_aplus] += 15
+    df_cand['score_momentum'] = score_momentum
     df_cand['score_risk'] = score_risk
-    df_cand['total_score'] = (score_trend * weights['trend'] + df_cand['score_momentum'] * weights['momentum'] + score_risk * weights['risk'])
-    is_aplus = ((df_cand['rs_rank'] >= 0.85) & (df_cand['ma20'] > df_cand['ma60']) & (df_cand['slope'] > 0) & (df_cand['vol_ratio'].between(1.5, 2.5)) & (df_cand['score_risk'] > 60))
-    df_cand.loc[is_aplus, 'total_score'] += 15
-    df_cand['total_score'] = df_cand['total_score'].clip(upper=100)
+    df_cand['total_score'] = np.minimum(total, 100)
     df_cand['is_aplus'] = is_aplus
     return df_cand
 
@@ -354,142 +623,229 @@ def check_entry_gate(bias, rsi):
     return "PASS", "符合"
 
 # --- 7. 繪圖引擎 ---
+def submit_chart_render(*args):
+    """把繪圖丟給 CHART_POOL；子行程被系統砍掉 (例如 OOM) 後行程池會永久失效，此時重建一次再送"""
+    global CHART_POOL
+    pool = CHART_POOL
+    try:
+        return pool.submit(render_stock_chart, *args)
+    except BrokenProcessPool:
+        with chart_pool_lock:
+            if CHART_POOL is pool:
+                logger.warning("繪圖行程池已失效，重新建立")
+                pool.shutdown(wait=False)
+                CHART_POOL = create_chart_pool()
+            return CHART_POOL.submit(render_stock_chart, *args)
+
+def put_chart_image(filename, data):
+    # ETag 依圖檔內容計算：同一分鐘內重畫的圖檔名相同，內容變了 ETag 也要跟著變
+    etag = hashlib.md5(data).hexdigest()
+    with img_lock:
+        IMG_CACHE[filename] = (time.time(), data, etag)
+        IMG_CACHE.move_to_end(filename)
+        while len(IMG_CACHE) > IMG_CACHE_MAX: IMG_CACHE.popitem(last=False)
+
+def get_chart_image(filename):
+    """回傳 (PNG bytes, ETag)；不存在或已過期回傳 None"""
+    with img_lock:
+        item = IMG_CACHE.get(filename)
+        if item and (time.time() - item[0]) < IMG_CACHE_TTL_SECONDS:
+            return item[1:]
+        IMG_CACHE.pop(filename, None)
+    return None
+
+def render_stock_chart(df, stock_name, code):
+    """繪製價格/成交量/RSI 三聯圖，回傳 PNG bytes (於 CHART_POOL 子行程執行)"""
+    Figure, FigureCanvas = load_plotting()
+    my_font = load_chart_font()
+    # 每個繪圖執行緒重用同一張 Figure 與 Agg 畫布，只清空內容，不重配繪圖緩衝區
+    fig = getattr(render_local, 'fig', None)
+    if fig is None:
+        fig = Figure(figsize=(10, 10))
+        FigureCanvas(fig)
+        render_local.fig = fig
+    else:
+        fig.clf()
+    ax1 = fig.add_subplot(3, 1, 1)
+    price_line = df['Close'] if len(df) <= CHART_MAX_POINTS else df['Close'].iloc[::2]
+    ax1.plot(price_line.index, price_line, color='black', alpha=0.6, label='Price')
+    if len(df) >= 20: ax1.plot(df.index, df['MA20'], color='#FF9900', linestyle='--', label='MA20')
+    if len(df) >= 60: ax1.plot(df.index, df['MA60'], color='#0066CC', linewidth=2, label='MA60')
+    try: ax1.set_title(f"{stock_name} ({code})", fontproperties=my_font, fontsize=18)
+    except: ax1.set_title(f"{code}", fontsize=18)
+    ax1.legend(loc='upper left', prop=my_font); ax1.grid(True, linestyle=':', alpha=0.5)
+    ax2 = fig.add_subplot(3, 1, 2)
+    cols = ['red' if c >= o else 'green' for c, o in zip(df['Close'], df['Open'])]
+    ax2.bar(df.index, df['Volume'], color=cols, alpha=0.8)
+    ax2.set_ylabel("Volume", fontproperties=my_font); ax2.grid(True, linestyle=':', alpha=0.3)
+    ax3 = fig.add_subplot(3, 1, 3)
+    ax3.plot(df.index, df['RSI'], color='purple')
+    ax3.axhline(80, color='red', linestyle='--'); ax3.axhline(30, color='green', linestyle='--')
+    ax3.set_ylabel("RSI", fontproperties=my_font); ax3.grid(True, linestyle=':', alpha=0.3)
+    # 邊界固定好，不用 bbox_inches='tight' (它會為了量邊界多畫一次整張圖)；PNG 用最低壓縮等級，檔案稍大但編碼快
+    fig.subplots_adjust(left=0.08, right=0.97, top=0.95, hspace=0.25)
+    fig.autofmt_xdate(bottom=0.07)
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', pil_kwargs={'compress_level': 1})
+    return buf.getvalue()
+
 def create_stock_chart(stock_code):
-    gc.collect()
     result_file = None
     result_text = ""
-    with plot_lock:
+    try:
+        target = stock_code.upper().strip()
+        # 本益比與大盤資料各是一次 FinMind 往返，和 K 線同時抓，不必排隊等
+        info_future = LOOKUP_POOL.submit(get_stock_info_finmind, target)
+        bench_future = LOOKUP_POOL.submit(get_benchmark_data)
+        df = fetch_data_finmind(target)
+
+        if df.empty: return None, f"FinMind 查無代號 {target} 資料。"
+        
+        stock_name = get_stock_name(target)
+        info_data = info_future.result()
+        # 收盤價以 float32 儲存，轉回 Python float 再運算，EPS 等文字才不會印出 float32 的尾數
+        price = float(df['Close'].iat[-1])
+        eps = get_eps_from_price_pe(price, info_data.get('pe'))
+
+        # RS 只需最後一天：取共同交易日的頭尾兩點算 20 日報酬比，不建整條 pct_change
         try:
-            target = stock_code.upper().strip()
-            df = fetch_data_finmind(target)
+            bench = bench_future.result()
+            rs_val = 1.0
+            if not bench.empty:
+                common = df.index.intersection(bench.index)
+                if len(common) > 20:
+                    rs_val = np.nan
+                    if common[-1] == df.index[-1]:
+                        ends = common[[-21, -1]]
+                        s0, s1 = df.loc[ends, 'Close'].to_numpy(dtype=float)
+                        b0, b1 = bench.loc[ends, 'Close'].to_numpy(dtype=float)
+                        rs_val = (s1 / s0) / (b1 / b0)
+        except: rs_val = 1.0
+
+        df = df.assign(**cached_chart_indicators(target, df))
+        # 指標算好就先把繪圖丟給子行程，診斷文字在這段時間內組好
+        chart_args = (df[['Open', 'Close', 'Volume', 'MA20', 'MA60', 'RSI']].astype(np.float32), stock_name, target.split('.')[0])
+        chart_future = submit_chart_render(*chart_args)
+
+        price, ma20, ma60, slope, rsi, adx, atr, vol_ratio = (
+            df[['Close', 'MA20', 'MA60', 'Slope', 'RSI', 'ADX', 'ATR', 'Vol_Ratio']].iloc[-1].to_numpy(dtype=float))
+        if np.isnan(slope): slope = 0
+        if np.isnan(rsi): rsi = 50
+        if np.isnan(adx): adx = 0
+        if not atr > 0: atr = price*0.02
+        if np.isnan(rs_val): rs_val = 1.0
+        rs_str = "無數據" if rs_val == 1.0 else ("強於大盤 🦅" if rs_val > 1.05 else ("弱於大盤 🐢" if rs_val < 0.95 else "跟隨大盤"))
+        if np.isnan(vol_ratio): vol_ratio = 1.0
+
+        kline_pattern, kline_score = detect_kline_pattern(df)
+        valuation_status_str, bias_val = get_valuation_status(price, ma60, info_data)
+
+        if adx < 20: trend_quality = "盤整 💤"
+        elif adx > 40: trend_quality = "強勁 🔥"
+        else: trend_quality = "確立 ✅"
+
+        if ma20 > ma60 and slope > 0: trend_dir = "多頭"
+        elif ma20 < ma60 and slope < 0: trend_dir = "空頭"
+        else: trend_dir = "震盪"
+
+        stop = price - atr * 1.5
+        final_stop = max(stop, ma20) if trend_dir == "多頭" and ma20 < price else stop
+        target_price_val = price + atr * 3 
+
+        entry_status, entry_msg = check_entry_gate(bias_val, rsi)
+        entry_warning = f"\n{entry_msg}" if entry_status != "PASS" else ""
+
+        advice = "觀望"
+        if trend_dir == "多頭":
+            if kline_score <= -0.5: advice = f"⚠️ 警戒：趨勢雖多，但{kline_pattern.split(' ')[0]}，留意回檔"
+            elif "過熱" in valuation_status_str: advice = "⛔ 價值過熱，禁止追價"
+            elif entry_status == "BAN": advice = "⛔ 指標過熱，禁止進場"
+            elif entry_status == "WAIT": advice = "⏳ 短線乖離大，暫緩"
+            elif kline_score > 0: advice = f"✅ 買點浮現 ({kline_pattern.split(' ')[0]})"
+            elif adx < 20: advice = "盤整中，多看少做"
+            elif rs_val < 0.95: advice = "弱於大盤，恐補跌"
+            elif 60 <= rsi <= 75: advice = "量價健康，可尋買點"
+            else: advice = "沿月線操作"
+        elif trend_dir == "空頭":
+            if kline_score > 0.5: advice = f"空頭反彈 ({kline_pattern.split(' ')[0]})，老手搶短"
+            else: advice = "趨勢向下，勿接刀"
+        else:
+            if kline_score > 0.5: advice = f"震盪轉強 ({kline_pattern.split(' ')[0]})，老手試單"
+            else: advice = "方向不明，建議觀望"
+
+        exit_rule = f"🛑 **停損鐵律**：跌破 {final_stop:.1f} 市價出場。"
+        analysis_report = (
+            f"📊 {stock_name} ({target.split('.')[0]}) 診斷 [FinMind]\n"
+            f"💰 現價: {price:.1f} | EPS: {eps}\n"
+            f"📈 趨勢: {trend_dir} | {trend_quality}\n"
+            f"🕯️ {kline_pattern}\n"
+            f"💎 價值: {valuation_status_str}\n"
+            f"🦅 RS值: {rs_val:.2f} ({rs_str})\n"
+            f"------------------\n"
+            f"🎯 目標: {target_price_val:.1f} | 🛑 停損: {final_stop:.1f}\n"
+            f"{exit_rule}\n"
+            f"💡 建議: {advice}"
+            f"{entry_warning}\n\n"
+            f"{get_psychology_reminder()}"
+        )
+        result_text = analysis_report
 
-            if df.empty: return None, f"FinMind 查無代號 {target} 資料。"
-            
-            stock_name = get_stock_name(target)
-            info_data = get_stock_info_finmind(target)
-            last = df.iloc[-1]
-            price = last['Close']
-            eps = get_eps_from_price_pe(price, info_data.get('pe'))
+        filename = f"{target.split('.')[0]}_{int(time.time() // 60)}.png"
+        try:
+            png = chart_future.result(timeout=CHART_TIMEOUT_SECONDS)
+        except BrokenProcessPool:
+            # 子行程在繪圖途中死掉：行程池已標記失效，重送時會重建，只重試這一次
+            png = submit_chart_render(*chart_args).result(timeout=CHART_TIMEOUT_SECONDS)
+        put_chart_image(filename, png)
+        result_file = filename
+    except Exception as e:
+        return None, f"繪圖失敗: {str(e)}\n\n{result_text}"
+    return result_file, result_text
 
-            try:
-                bench = get_benchmark_data()
-                if not bench.empty:
-                    common = df.index.intersection(bench.index)
-                    if len(common) > 20:
-                        s_ret = df.loc[common, 'Close'].pct_change(20)
-                        b_ret = bench.loc[common, 'Close'].pct_change(20)
-                        df.loc[common, 'RS'] = (1+s_ret)/(1+b_ret)
-                    else: df['RS'] = 1.0
-                else: df['RS'] = 1.0
-            except: df['RS'] = 1.0
-
-            if len(df) < 60:
-                df['MA20'] = df['Close'].rolling(20).mean(); df['MA60'] = df['MA20']
-            else:
-                df['MA20'] = df['Close'].rolling(20).mean(); df['MA60'] = df['Close'].rolling(60).mean()
-            df['Slope'] = df['MA20'].diff(5)
-            delta = df['Close'].diff()
-            gain = (delta.where(delta>0, 0)).rolling(14).mean()
-            loss = (-delta.where(delta<0, 0)).rolling(14).mean()
-            rs_idx = gain/loss
-            df['RSI'] = 100-(100/(1+rs_idx))
-            df['Vol_MA20'] = df['Volume'].rolling(20).mean()
-            df['Vol_Ratio'] = df['Volume'] / df['Vol_MA20']
-            df['ADX'] = calculate_adx(df)
-            df['ATR'] = calculate_atr(df)
-            df['OBV'] = calculate_obv(df)
-
-            last = df.iloc[-1]
-            price = last['Close']
-            ma20, ma60 = last['MA20'], last['MA60']
-            slope = last['Slope'] if not pd.isna(last['Slope']) else 0
-            rsi = last['RSI'] if not pd.isna(last['RSI']) else 50
-            adx = last['ADX'] if not pd.isna(last['ADX']) else 0
-            atr = last['ATR'] if not pd.isna(last['ATR']) and last['ATR'] > 0 else price*0.02
-            rs_val = last['RS'] if 'RS' in df.columns and not pd.isna(last['RS']) else 1.0
-            rs_str = "無數據" if rs_val == 1.0 else ("強於大盤 🦅" if rs_val > 1.05 else ("弱於大盤 🐢" if rs_val < 0.95 else "跟隨大盤"))
-            vol_ratio = last['Vol_Ratio'] if not pd.isna(last['Vol_Ratio']) else 1.0
-
-            kline_pattern, kline_score = detect_kline_pattern(df)
-            valuation_status_str, bias_val = get_valuation_status(price, ma60, info_data)
-
-            if adx < 20: trend_quality = "盤整 💤"
-            elif adx > 40: trend_quality = "強勁 🔥"
-            else: trend_quality = "確立 ✅"
-
-            if ma20 > ma60 and slope > 0: trend_dir = "多頭"
-            elif ma20 < ma60 and slope < 0: trend_dir = "空頭"
-            else: trend_dir = "震盪"
-
-            stop = price - atr * 1.5
-            final_stop = max(stop, ma20) if trend_dir == "多頭" and ma20 < price else stop
-            target_price_val = price + atr * 3 
-
-            entry_status, entry_msg = check_entry_gate(bias_val, rsi)
-            entry_warning = f"\n{entry_msg}" if entry_status != "PASS" else ""
-
-            advice = "觀望"
-            if trend_dir == "多頭":
-                if kline_score <= -0.5: advice = f"⚠️ 警戒：趨勢雖多，但{kline_pattern.split(' ')[0]}，留意回檔"
-                elif "過熱" in valuation_status_str: advice = "⛔ 價值過熱，禁止追價"
-                elif entry_status == "BAN": advice = "⛔ 指標過熱，禁止進場"
-                elif entry_status == "WAIT": advice = "⏳ 短線乖離大，暫緩"
-                elif kline_score > 0: advice = f"✅ 買點浮現 ({kline_pattern.split(' ')[0]})"
-                elif adx < 20: advice = "盤整中，多看少做"
-                elif rs_val < 0.95: advice = "弱於大盤，恐補跌"
-                elif 60 <= rsi <= 75: advice = "量價健康，可尋買點"
-                else: advice = "沿月線操作"
-            elif trend_dir == "空頭":
-                if kline_score > 0.5: advice = f"空頭反彈 ({kline_pattern.split(' ')[0]})，老手搶短"
-                else: advice = "趨勢向下，勿接刀"
-            else:
-                if kline_score > 0.5: advice = f"震盪轉強 ({kline_pattern.split(' ')[0]})，老手試單"
-                else: advice = "方向不明，建議觀望"
-
-            exit_rule = f"🛑 **停損鐵律**：跌破 {final_stop:.1f} 市價出場。"
-            analysis_report = (
-                f"📊 {stock_name} ({target.split('.')[0]}) 診斷 [FinMind]\n"
-                f"💰 現價: {price:.1f} | EPS: {eps}\n"
-                f"📈 趨勢: {trend_dir} | {trend_quality}\n"
-                f"🕯️ {kline_pattern}\n"
-                f"💎 價值: {valuation_status_str}\n"
-                f"🦅 RS值: {rs_val:.2f} ({rs_str})\n"
-                f"------------------\n"
-                f"🎯 目標: {target_price_val:.1f} | 🛑 停損: {final_stop:.1f}\n"
-                f"{exit_rule}\n"
-                f"💡 建議: {advice}"
-                f"{entry_warning}\n\n"
-                f"{get_psychology_reminder()}"
-            )
-            result_text = analysis_report
-
-            fig = Figure(figsize=(10, 10))
-            canvas = FigureCanvas(fig)
-            ax1 = fig.add_subplot(3, 1, 1)
-            ax1.plot(df.index, df['Close'], color='black', alpha=0.6, label='Price')
-            if len(df) >= 20: ax1.plot(df.index, df['MA20'], color='#FF9900', linestyle='--', label='MA20')
-            if len(df) >= 60: ax1.plot(df.index, df['MA60'], color='#0066CC', linewidth=2, label='MA60')
-            try: ax1.set_title(f"{stock_name} ({target.split('.')[0]})", fontproperties=my_font, fontsize=18)
-            except: ax1.set_title(f"{target.split('.')[0]}", fontsize=18)
-            ax1.legend(loc='upper left', prop=my_font); ax1.grid(True, linestyle=':', alpha=0.5)
-            ax2 = fig.add_subplot(3, 1, 2)
-            cols = ['red' if c >= o else 'green' for c, o in zip(df['Close'], df['Open'])]
-            ax2.bar(df.index, df['Volume'], color=cols, alpha=0.8)
-            ax2.set_ylabel("Volume", fontproperties=my_font); ax2.grid(True, linestyle=':', alpha=0.3)
-            ax3 = fig.add_subplot(3, 1, 3)
-            ax3.plot(df.index, df['RSI'], color='purple')
-            ax3.axhline(80, color='red', linestyle='--'); ax3.axhline(30, color='green', linestyle='--')
-            ax3.set_ylabel("RSI", fontproperties=my_font); ax3.grid(True, linestyle=':', alpha=0.3)
-            fig.autofmt_xdate()
-            filename = f"{target.split('.')[0]}_{int(time.time())}.png"
-            filepath = os.path.join(static_dir, filename)
-            fig.savefig(filepath, bbox_inches='tight')
-            result_file = filename
-            del fig; del canvas
+# 同一檔股票同一分鐘內重複查詢，直接沿用已產生的線圖與診斷文字；同時間的相同查詢只畫一次
+CHART_RESULT_CACHE = {}
+CHART_INFLIGHT = {}
+CHART_WAIT_TIMEOUT_MSG = "圖表產生逾時，請稍後再試"
+chart_cache_lock = threading.Lock()
+
+def get_cached_chart(stock_code):
+    key = (stock_code.upper().strip(), int(time.time() // 60))
+    with chart_cache_lock:
+        cached = CHART_RESULT_CACHE.get(key)
+    if cached and get_chart_image(cached[0]) is not None:
+        return cached
+    return None
+
+def cached_stock_chart(stock_code):
+    cached = get_cached_chart(stock_code)
+    if cached: return cached
+    code = stock_code.upper().strip()
+    with chart_cache_lock:
+        pending = CHART_INFLIGHT.get(code)
+        if pending is None:
+            CHART_INFLIGHT[code] = future = Future()
+    if pending is not None:
+        # 相同代號已有人在產圖，等待共用結果；等太久或對方出錯也要回覆使用者，不能把例外往上丟
+        try:
+            return pending.result(timeout=CHART_TIMEOUT_SECONDS * 2)
         except Exception as e:
-            return None, f"繪圖失敗: {str(e)}\n\n{result_text}"
-        finally: gc.collect()
-    return result_file, result_text
+            logger.warning(f"等待 {code} 線圖失敗: {e!r}")
+            return None, CHART_WAIT_TIMEOUT_MSG
+    try:
+        img, txt = create_stock_chart(stock_code)
+        if img:
+            bucket = int(time.time() // 60)
+            with chart_cache_lock:
+                for k in [k for k in CHART_RESULT_CACHE if k[1] != bucket]: del CHART_RESULT_CACHE[k]
+                CHART_RESULT_CACHE[(code, bucket)] = (img, txt)
+        future.set_result((img, txt))
+        return img, txt
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with chart_cache_lock:
+            CHART_INFLIGHT.pop(code, None)
 
 # --- 8. 選股功能 ---
 def scan_potential_stocks(max_price=None, sector_name=None):
@@ -507,67 +863,77 @@ def scan_potential_stocks(max_price=None, sector_name=None):
         bench = get_benchmark_data()
         if not bench.empty:
             mkt = detect_market_state(bench)
-            w = {'TREND': {'trend': 0.6, 'momentum': 0.3, 'risk': 0.1}, 'RANGE': {'trend': 0.4, 'momentum': 0.2, 'risk': 0.4}, 'VOLATILE': {'trend': 0.3, 'momentum': 0.4, 'risk': 0.3}}[mkt]
-            b_ret = bench['Close'].pct_change(20).iloc[-1]
+            w = SCORE_WEIGHTS[mkt]
+            bench_close = bench['Close'].to_numpy(dtype=float)
+            b_ret = bench_close[-1] / bench_close[-21] - 1 if len(bench_close) > 20 else np.nan
             market_commentary = get_market_commentary(mkt)
             stop_mult, target_mult, max_days, trade_type, risk_desc, max_trades = get_trade_params(mkt)
             if mkt == 'VOLATILE':
                 return f"🔴 **市場熔斷啟動**\n\n目前盤勢為【{mkt}】，風險極高。\n系統已強制停止選股功能，請保留現金，靜待落底訊號。", []
         else:
-            mkt, w, b_ret, trade_type, risk_desc = 'RANGE', {'trend': 0.4, 'momentum': 0.2, 'risk': 0.4}, 0, "區間突破單", "未知"
+            mkt, w, b_ret, trade_type, risk_desc = 'RANGE', SCORE_WEIGHTS['RANGE'], 0, "區間突破單", "未知"
             stop_mult, target_mult, max_days, max_trades = 1.0, 1.5, 10, "1"
             market_commentary = "⚠️ 無法取得大盤狀態，請保守操作。"
 
-        def process_stock_for_scan(stock):
+        def fetch_stock_for_scan(stock):
             try:
-                df = fetch_data_finmind(stock)
+                df = get_watchlist_data(stock)
                 if df.empty or len(df) < 60: return None
-                price = df['Close'].iloc[-1]
-                if max_price and price > max_price: return None
-
-                ma20 = df['Close'].rolling(20).mean(); ma60 = df['Close'].rolling(60).mean()
-                v_ma = df['Volume'].rolling(20).mean()
-                slope = ma20.diff(5).iloc[-1]
-                vol_r = df['Volume'].iloc[-1]/v_ma.iloc[-1] if v_ma.iloc[-1]>0 else 0
-                s_ret = df['Close'].pct_change(20).iloc[-1]
+                if max_price and df['Close'].iat[-1] > max_price: return None
+                return stock, df.iloc[-60:]
+            except: return None
+
+        frames = [res for res in FETCH_POOL.map(fetch_stock_for_scan, watch_list) if res]
+
+        # 所有股票最後 60 根 K 棒疊成 (天數 × 股票) 矩陣，一次向量化算完指標
+        if frames:
+            close = np.column_stack([f['Close'].to_numpy(dtype=float) for _, f in frames])
+            # 評分只用到最後一天 (斜率另需 5 天前的 MA20)，直接取尾段平均，不算整條移動平均
+            curr_ma20 = close[-20:].mean(axis=0); curr_ma60 = close[-60:].mean(axis=0)
+            slope = curr_ma20 - close[-25:-5].mean(axis=0)
+            # 先用趨勢條件 (MA20 > MA60 且斜率向上) 篩掉不合格的股票，其餘指標只算留下來的
+            keep = (curr_ma20 > curr_ma60) & (slope > 0)
+            frames = [fr for fr, k in zip(frames, keep) if k]
+            close, curr_ma20, curr_ma60, slope = close[:, keep], curr_ma20[keep], curr_ma60[keep], slope[keep]
+
+        if frames:
+            codes = [s for s, _ in frames]
+            high = np.column_stack([f['High'].to_numpy(dtype=float) for _, f in frames])
+            low = np.column_stack([f['Low'].to_numpy(dtype=float) for _, f in frames])
+            volume = np.column_stack([f['Volume'].to_numpy(dtype=float) for _, f in frames])
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                price = close[-1]
+                v_ma = volume[-20:].mean(axis=0)
+                vol_r = np.where(v_ma > 0, volume[-1] / v_ma, 0)
+                s_ret = close[-1] / close[-21] - 1
                 rs = (1+s_ret)/(1+b_ret)
-                tr = (df['High']-df['Low']).rolling(14).mean().iloc[-1]
-                atr = tr if tr > 0 else price*0.02
-                
-                delta = df['Close'].diff()
-                gain = (delta.where(delta>0, 0)).rolling(14).mean()
-                loss = (-delta.where(delta<0, 0)).rolling(14).mean()
-                rs_idx = gain/loss
-                rsi = 100-(100/(1+rs_idx))
-                curr_rsi = rsi.iloc[-1]
-                curr_ma20 = ma20.iloc[-1]; curr_ma60 = ma60.iloc[-1]
-
-                if curr_ma20 > curr_ma60 and slope > 0:
-                    return {
-                        'stock': stock, 'price': price, 'ma20': curr_ma20, 'ma60': curr_ma60,
-                        'slope': slope, 'vol_ratio': vol_r, 'atr': atr, 'rs_raw': rs, 'rs_rank': 0,
-                        'rsi': curr_rsi 
-                    }
-            except: pass
-            return None
-
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            future_to_stock = {executor.submit(process_stock_for_scan, stock): stock for stock in watch_list}
-            for future in as_completed(future_to_stock):
-                res = future.result()
-                if res: candidates.append(res)
-
-        if not candidates:
+                tr = (high[-14:] - low[-14:]).mean(axis=0)
+                atr = np.where(tr > 0, tr, price*0.02)
+
+                rsi = calculate_rsi(close[-15:], 14)[-1]
+
+            candidates = pd.DataFrame({
+                'stock': codes, 'price': price, 'ma20': curr_ma20, 'ma60': curr_ma60,
+                'slope': slope, 'vol_ratio': vol_r, 'atr': atr, 'rs_raw': rs, 'rs_rank': 0.0,
+                'rsi': rsi
+            })
+        else:
+            candidates = pd.DataFrame()
+
+        if candidates.empty:
              return title_prefix, ["今日掃描無符合強勢條件之個股，或因 API 限制查無資料。"]
 
-        if candidates:
-            df = pd.DataFrame(candidates)
+        if not candidates.empty:
+            df = candidates
             df['rs_rank'] = df['rs_raw'].rank(pct=True)
             df = calculate_score(df, w)
             
             th = 70 if mkt == 'RANGE' else 60
             df = df.sort_values('total_score', ascending=False)
             picks = df[df['total_score']>=th].head(6)
+            # 進場乖離一次對入選股票整欄算好，迴圈內只讀值
+            picks = picks.assign(bias=(picks['price'] - picks['ma20']) / picks['ma20'] * 100)
             
             icons = ["🥇", "🥈", "🥉", "4️⃣", "5️⃣", "6️⃣"]
             for i, r in enumerate(picks.itertuples()):
@@ -577,8 +943,7 @@ def scan_potential_stocks(max_price=None, sector_name=None):
                 pos = get_position_sizing(r.total_score)
                 icon = icons[i] if i < 6 else "🔹"
                 
-                bias_val = (r.price - r.ma20) / r.ma20 * 100
-                entry_status, _ = check_entry_gate(bias_val, r.rsi)
+                entry_status, _ = check_entry_gate(r.bias, r.rsi)
                 
                 if entry_status == "BAN": continue
                 gate_tag = " (⚠️等回測)" if entry_status == "WAIT" else ""
@@ -601,6 +966,48 @@ def scan_potential_stocks(max_price=None, sector_name=None):
 
     return title_prefix, recommendations
 
+# 選股結果短暫快取：同一條件 60 秒內直接回傳；過期 30 秒內先回舊結果並於背景更新
+SCAN_CACHE = {}
+SCAN_INFLIGHT = {}
+SCAN_CACHE_TTL_SECONDS = 60
+SCAN_CACHE_STALE_SECONDS = 30
+scan_lock = threading.Lock()
+
+def refresh_scan_cache(key):
+    try:
+        started = time.time()
+        result = scan_potential_stocks(sector_name=key[0], max_price=key[1])
+        with scan_lock:
+            SCAN_CACHE[key] = {'time': time.time(), 'result': result}
+        logger.info(f"選股快取更新 {key}: 耗時 {time.time() - started:.2f}s")
+        return result
+    finally:
+        with scan_lock:
+            done = SCAN_INFLIGHT.pop(key, None)
+        if done: done.set()
+
+def cached_scan(max_price=None, sector_name=None):
+    key = (sector_name, max_price)
+    with scan_lock:
+        entry = SCAN_CACHE.get(key)
+        age = time.time() - entry['time'] if entry else None
+        if entry and age < SCAN_CACHE_TTL_SECONDS:
+            return entry['result']
+        pending = SCAN_INFLIGHT.get(key)
+        if pending is None:
+            SCAN_INFLIGHT[key] = threading.Event()
+        if entry and age < SCAN_CACHE_TTL_SECONDS + SCAN_CACHE_STALE_SECONDS:
+            if pending is None:
+                threading.Thread(target=refresh_scan_cache, args=(key,), daemon=True).start()
+            return entry['result']
+    if pending is None:
+        return refresh_scan_cache(key)
+    # 相同條件已有人在掃描，等待共用結果
+    pending.wait(timeout=60)
+    with scan_lock:
+        entry = SCAN_CACHE.get(key)
+    return entry['result'] if entry else scan_potential_stocks(sector_name=sector_name, max_price=max_price)
+
 # --- ★ v26.0 雲端量化回測引擎 ---
 def run_multi_strategy_backtest(stock_code):
     clean_code = stock_code.upper().replace('.TW', '').replace('.TWO', '').strip()
@@ -614,11 +1021,10 @@ def run_multi_strategy_backtest(stock_code):
     
     try:
         # 多線程抓取四大資料庫
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            f_price = executor.submit(fetch_data_finmind, clean_code, 400, start_date)
-            f_bench = executor.submit(fetch_data_finmind, "0050", 400, start_date)
-            f_inst = executor.submit(call_finmind_api, "TaiwanStockInstitutionalInvestorsBuySell", clean_code, start_date)
-            f_margin = executor.submit(call_finmind_api, "TaiwanStockMarginPurchaseShortSale", clean_code, start_date)
+        f_price = FETCH_POOL.submit(fetch_data_finmind, clean_code, 400, start_date)
+        f_bench = FETCH_POOL.submit(fetch_data_finmind, "0050", 400, start_date)
+        f_inst = FETCH_POOL.submit(call_finmind_api, "TaiwanStockInstitutionalInvestorsBuySell", clean_code, start_date)
+        f_margin = FETCH_POOL.submit(call_finmind_api, "TaiwanStockMarginPurchaseShortSale", clean_code, start_date)
         
         df = f_price.result()
         bench_df = f_bench.result()
@@ -788,6 +1194,72 @@ def run_multi_strategy_backtest(stock_code):
         return f"❌ 回測發生系統錯誤: {str(e)}"
 
 # --- 9. Bot Handler ---
+# 功能選單內容固定，啟動時建好訊息物件重複使用
+# 指令字串一律 intern，查表時多半能以同一物件直接命中，省去逐字比對
+# 英文指令不分大小寫：集合只放小寫，查表前訊息先 casefold 一次
+HELP_TRIGGERS = frozenset(map(sys.intern, ("功能", "指令", "help", "menu")))
+TUTORIAL_TRIGGERS = frozenset(map(sys.intern, ("說明", "教學", "名詞解釋", "新手", "看不懂")))
+CHART_ASYNC_PUSH = os.environ.get('CHART_ASYNC_PUSH', '') == '1'
+CHART_PENDING_MSG = TextSendMessage(text="⏳ 圖表生成中，約 5 秒後送達")
+MENU_MSG = TextSendMessage(text=(
+    f"🤖 **股市全能助理** ({APP_VERSION})\n"
+    "======================\n\n"
+    "🔍 **個股診斷**\n"
+    "輸入：`2330`\n"
+    "👉 線圖、K線型態、價值評估、教練建議\n\n"
+    "🔬 **10大策略回測 (Premium)**\n"
+    "輸入：`回測 2330`\n"
+    "👉 執行一年期策略回測與優缺點分析\n\n"
+    "📊 **智能選股 (極速版)**\n"
+    "輸入：`推薦` 或 `選股`\n"
+    "👉 自動偵測盤勢，A+訊號優先展示\n\n"
+    "💰 **小資選股**\n"
+    "輸入：`小資` 或 `百元推薦`\n"
+    "👉 掃描 100 元以內的強勢股\n\n"
+    "🏅 **績優選股**\n"
+    "輸入：`績優股`\n"
+    "👉 掃描精選績優股\n\n"
+    "📖 **K線教學**\n"
+    "輸入：`說明`"
+))
+
+SCAN_HEADER = "\n(Score評分制)\n====================\n"
+# 回覆送出交給執行緒池，處理流程不必等 LINE API 往返
+REPLY_POOL = ThreadPoolExecutor(max_workers=16)
+REPLY_BACKLOG_WARN = 32
+reply_pending = {'count': 0}
+reply_lock = threading.Lock()
+
+def on_reply_done(future):
+    with reply_lock:
+        reply_pending['count'] -= 1
+    if future.exception():
+        logger.error(f"LINE 回覆失敗: {future.exception()}")
+
+def submit_line_call(api_call, target, messages):
+    with reply_lock:
+        reply_pending['count'] += 1
+        backlog = reply_pending['count']
+    if backlog > REPLY_BACKLOG_WARN:
+        logger.warning(f"LINE 回覆佇列積壓: {backlog} 筆")
+    REPLY_POOL.submit(api_call, target, messages).add_done_callback(on_reply_done)
+
+def reply(reply_token, messages):
+    submit_line_call(line_bot_api.reply_message, reply_token, messages)
+
+def push(user_id, messages):
+    submit_line_call(line_bot_api.push_message, user_id, messages)
+
+# 會重複出現的回覆 (熔斷提示、選股結果、固定說明) 共用同一個訊息物件
+@functools.lru_cache(maxsize=256)
+def text_message(text):
+    return TextSendMessage(text=text)
+
+def format_scan_reply(prefix, recs):
+    if not recs: return "無符合條件個股"
+    # 標題併進第一筆，整段回覆只做一次 join，不另外產生中間字串
+    return "\n\n".join((f"📊 {prefix}{SCAN_HEADER}{recs[0]}", *recs[1:]))
+
 @app.route("/callback", methods=['POST'])
 def callback():
     sig = request.headers.get('X-Line-Signature')
@@ -802,108 +1274,164 @@ def callback():
 def home(): return f"Stock Bot: {APP_VERSION}"
 
 @app.route('/images/<filename>')
-def serve_image(filename): return send_from_directory(static_dir, filename)
+def serve_image(filename):
+    image = get_chart_image(filename)
+    if image is None: abort(404)
+    data, etag = image
+    # LINE 會以同一網址抓原圖與預覽圖，第二次以 ETag 驗證即回 304
+    resp = send_file(io.BytesIO(data), mimetype='image/png', etag=etag, conditional=True)
+    resp.headers['Cache-Control'] = "public, max-age=300, stale-while-revalidate=60"
+    return resp
+
+# LINE webhook 逾時或失敗會重送同一事件 (webhookEventId 不變)，處理過的事件 ID 記一段時間，重送時直接略過
+SEEN_EVENTS = OrderedDict()
+SEEN_EVENTS_MAX = 2048
+SEEN_EVENTS_TTL_SECONDS = 300
+seen_lock = threading.Lock()
+
+def is_duplicate_event(event):
+    event_id = getattr(event, 'webhook_event_id', None)
+    if not event_id: return False
+    now = time.time()
+    with seen_lock:
+        while SEEN_EVENTS and now - next(iter(SEEN_EVENTS.values())) > SEEN_EVENTS_TTL_SECONDS:
+            SEEN_EVENTS.popitem(last=False)
+        if event_id in SEEN_EVENTS: return True
+        SEEN_EVENTS[event_id] = now
+        while len(SEEN_EVENTS) > SEEN_EVENTS_MAX: SEEN_EVENTS.popitem(last=False)
+    return False
 
 @handler.add(MessageEvent, message=TextMessage)
 def handle_message(event):
     msg = event.message.text.strip()
     if not msg: return
+    if is_duplicate_event(event):
+        logger.info(f"略過重送事件: {event.webhook_event_id}")
+        return
     user_id = event.source.user_id 
     is_blocked, block_msg = check_user_state(user_id)
     if is_blocked:
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=block_msg))
+        reply(event.reply_token, text_message(block_msg))
         return 
 
-    if msg in ["說明", "教學", "名詞解釋", "新手", "看不懂"]:
-        txt = (
-            "🎓 **股市小白 專有名詞懶人包**\n"
-            "======================\n\n"
-            "🕯️ **K線教學 (多轉空/空轉多)**\n"
-            "• 🌅 **晨星**: [空轉多] 跌勢末端出現一根紅K吃掉黑K，黎明將至。\n"
-            "• 🌃 **夜星**: [多轉空] 漲勢末端出現黑K吞噬紅K，黑夜降臨。\n"
-            "• 🔥 **吞噬**: [強力反轉] 今日K線完全包覆昨日，力道極強。\n"
-            "• 🔨 **錘頭**: [底部支撐] 長下影線，代表低檔有人接手。\n"
-            "• ☄️ **流星**: [頭部壓力] 長上影線，代表高檔有人出貨。\n"
-            "• 📈 **貫穿線**: [空轉多] 紅K收盤穿越昨黑K實體一半以上。\n"
-            "• 🌥️ **烏雲蓋頂**: [多轉空] 黑K收盤跌破昨紅K實體一半以上。\n"
-            "• 🐦 **鳥嘴**: [趨勢啟動] 5日線上穿20日線，開口擴大。\n"
-            "• 🍑 **屁股**: [見底訊號] W底雛形，跌勢末端連續紅黑K墊高。"
-        )
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=txt))
-        return
+    # 耗時的抓資料/繪圖丟到背景執行緒，webhook 立即回 200，避免 LINE 逾時重送
+    image_base_url = request.host_url + 'images/'
+    threading.Thread(target=process_message, args=(event, msg, image_base_url), daemon=True).start()
+
+def process_message(event, msg, image_base_url):
+    try:
+        dispatch_message(event, msg, image_base_url)
+    except Exception:
+        logger.error(f"訊息處理錯誤: {traceback.format_exc()}")
+
+TUTORIAL_MSG = TextSendMessage(text=(
+    "🎓 **股市小白 專有名詞懶人包**\n"
+    "======================\n\n"
+    "🕯️ **K線教學 (多轉空/空轉多)**\n"
+    "• 🌅 **晨星**: [空轉多] 跌勢末端出現一根紅K吃掉黑K，黎明將至。\n"
+    "• 🌃 **夜星**: [多轉空] 漲勢末端出現黑K吞噬紅K，黑夜降臨。\n"
+    "• 🔥 **吞噬**: [強力反轉] 今日K線完全包覆昨日，力道極強。\n"
+    "• 🔨 **錘頭**: [底部支撐] 長下影線，代表低檔有人接手。\n"
+    "• ☄️ **流星**: [頭部壓力] 長上影線，代表高檔有人出貨。\n"
+    "• 📈 **貫穿線**: [空轉多] 紅K收盤穿越昨黑K實體一半以上。\n"
+    "• 🌥️ **烏雲蓋頂**: [多轉空] 黑K收盤跌破昨紅K實體一半以上。\n"
+    "• 🐦 **鳥嘴**: [趨勢啟動] 5日線上穿20日線，開口擴大。\n"
+    "• 🍑 **屁股**: [見底訊號] W底雛形，跌勢末端連續紅黑K墊高。"
+))
+
+def reply_tutorial(event):
+    reply(event.reply_token, TUTORIAL_MSG)
+
+def reply_menu(event):
+    reply(event.reply_token, MENU_MSG)
+
+def reply_scan(event, **scan_kwargs):
+    p, r = cached_scan(**scan_kwargs)
+    reply(event.reply_token, text_message(format_scan_reply(p, r)))
+
+def reply_chart(event, msg, image_base_url):
+    if CHART_ASYNC_PUSH and get_cached_chart(msg) is None:
+        # 冷查詢先回「生成中」，畫好後改用推播送出 (會消耗推播額度，預設關閉)
+        reply(event.reply_token, CHART_PENDING_MSG)
+        send = functools.partial(push, event.source.user_id)
+    else:
+        send = functools.partial(reply, event.reply_token)
+    img, txt = cached_stock_chart(msg)
+    if img:
+        url = image_base_url + img
+        send([
+            ImageSendMessage(original_content_url=url, preview_image_url=url),
+            TextSendMessage(text=txt)
+        ])
+    else:
+        send(TextSendMessage(text=txt))
+
+# 完全比對的指令直接查表分派
+COMMAND_HANDLERS = {
+    **dict.fromkeys(TUTORIAL_TRIGGERS, reply_tutorial),
+    **dict.fromkeys(HELP_TRIGGERS, reply_menu),
+    sys.intern("推薦"): reply_scan,
+    sys.intern("百元推薦"): functools.partial(reply_scan, max_price=100),
+    sys.intern("百元績優推薦"): functools.partial(reply_scan, sector_name="百元績優"),
+}
 
+# 模糊辨識規則：關鍵字預先編成正則，依序比對，第一個命中的規則決定改寫後的指令
+FUZZY_COMMANDS = (
+    (re.compile("小資|便宜"), sys.intern("百元推薦")),
+    (re.compile("績優"), sys.intern("百元績優推薦")),
+    (re.compile("智能|選股|幫我選"), sys.intern("推薦")),
+)
+
+# 台股代號：4~6 位數字，可帶一碼英文 (如 00632R) 與 .TW/.TWO 後綴；不像代號的訊息不必進到抓資料與繪圖
+STOCK_CODE_PATTERN = re.compile(r"\d{4,6}[A-Z]?(\.TWO?)?", re.IGNORECASE)
+NOT_A_CODE_MSG = "請輸入股票代號 (例如 2330)，或輸入「功能」查看所有指令。"
+
+def dispatch_message(event, msg, image_base_url):
     # 指令模糊辨識
-    if any(x in msg for x in ["小資", "便宜"]):
-        msg = "百元推薦"
-    elif any(x in msg for x in ["績優"]):
-        msg = "百元績優推薦" 
-    elif any(x in msg for x in ["智能", "選股", "幫我選"]):
-        msg = "推薦"
+    for pattern, command_text in FUZZY_COMMANDS:
+        if pattern.search(msg):
+            msg = command_text
+            break
+    command_key = sys.intern(msg.casefold())
 
     # ★ v26.0 攔截回測指令
     if msg.startswith("回測") or msg.startswith("分析"):
         stock_code = msg.replace("回測", "").replace("分析", "").strip()
         if not stock_code:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="請輸入要回測的代號，例如：回測 2330"))
+            reply(event.reply_token, text_message("請輸入要回測的代號，例如：回測 2330"))
             return
         
         report_txt = run_multi_strategy_backtest(stock_code)
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=report_txt))
+        reply(event.reply_token, TextSendMessage(text=report_txt))
         return
 
-    if msg in ["功能", "指令", "Help", "help", "menu"]:
-        menu = (
-            f"🤖 **股市全能助理** ({APP_VERSION})\n"
-            "======================\n\n"
-            "🔍 **個股診斷**\n"
-            "輸入：`2330`\n"
-            "👉 線圖、K線型態、價值評估、教練建議\n\n"
-            "🔬 **10大策略回測 (Premium)**\n"
-            "輸入：`回測 2330`\n"
-            "👉 執行一年期策略回測與優缺點分析\n\n"
-            "📊 **智能選股 (極速版)**\n"
-            "輸入：`推薦` 或 `選股`\n"
-            "👉 自動偵測盤勢，A+訊號優先展示\n\n"
-            "💰 **小資選股**\n"
-            "輸入：`小資` 或 `百元推薦`\n"
-            "👉 掃描 100 元以內的強勢股\n\n"
-            "🏅 **績優選股**\n"
-            "輸入：`績優股`\n"
-            "👉 掃描精選績優股\n\n"
-            "📖 **K線教學**\n"
-            "輸入：`說明`"
-        )
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=menu))
+    command = COMMAND_HANDLERS.get(command_key)
+    if command:
+        command(event)
         return
 
+    # 模糊辨識已把含「選股」的訊息改寫成「…推薦」，這裡只需檢查一次「推薦」
     sector = None
-    for k in SECTOR_DICT:
-        if k in msg and ("推薦" in msg or "選股" in msg):
-            sector = k
-            break
+    if "推薦" in msg:
+        found = set(SECTOR_PATTERN.findall(msg))
+        if found: sector = next(k for k in SECTOR_KEYS if k in found)
     
     if sector:
-        p, r = scan_potential_stocks(sector_name=sector)
-        t = f"📊 {p}\n(Score評分制)\n====================\n" + "\n\n".join(r) if r else "無符合條件個股"
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=t))
-    elif msg == "推薦":
-        p, r = scan_potential_stocks()
-        t = f"📊 {p}\n(Score評分制)\n====================\n" + "\n\n".join(r) if r else "無符合條件個股"
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=t))
-    elif msg == "百元推薦":
-        p, r = scan_potential_stocks(max_price=100)
-        t = f"📊 {p}\n(Score評分制)\n====================\n" + "\n\n".join(r) if r else "無符合條件個股"
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=t))
+        reply_scan(event, sector_name=sector)
+    elif STOCK_CODE_PATTERN.fullmatch(msg):
+        reply_chart(event, msg, image_base_url)
     else:
-        img, txt = create_stock_chart(msg)
-        if img:
-            url = request.host_url.replace("http://", "https://") + 'images/' + img
-            line_bot_api.reply_message(event.reply_token, [
-                ImageSendMessage(original_content_url=url, preview_image_url=url),
-                TextSendMessage(text=txt)
-            ])
-        else:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=txt))
+        reply(event.reply_token, text_message(NOT_A_CODE_MSG))
+
+# forkserver 子行程會重新 import 本模組來取得 render_stock_chart 與 init_chart_worker (以 python app.py 執行時是以
+# __mp_main__ 載入)，載入期間 multiprocessing 會標記 _inheriting；行程池與背景執行緒只在主行程啟動，子行程不必再開一份
+if multiprocessing.parent_process() is None and not getattr(multiprocessing.current_process(), '_inheriting', False):
+    CHART_POOL = create_chart_pool()
+
+    # 字型下載放背景執行，不拖慢啟動；下載完成前的圖表先用預設字型
+    if not os.path.exists(font_file):
+        threading.Thread(target=download_font, daemon=True).start()
+    threading.Thread(target=start_watchlist_refresher, daemon=True).start()
 
 if __name__ == "__main__":
     app.run()
\ No newline at end of file
@@ -0,0 +1,12 @@
+# gunicorn 啟動設定 (`gunicorn app:app` 會自動讀取本檔)
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '10000')}"
+
+# 線圖 PNG、選股與使用者狀態都快取在行程記憶體，/images 取圖必須回到同一個行程，因此只開一個 worker；
+# webhook 併發交給執行緒處理，吃 CPU 的繪圖已另外丟到 CHART_POOL 子行程
+workers = 1
+worker_class = 'gthread'
+threads = 8
+timeout = 60
+keepalive = 5